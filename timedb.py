@@ -2,11 +2,20 @@
 import argparse
 import os.path
 import sqlite3
+import shutil
+import sys
+import tempfile
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
 
-import psycopg2
+import ijson
 import requests
 from psycopg2.extras import NamedTupleCursor
+from psycopg2.pool import ThreadedConnectionPool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 CREATE_SQL = """
 CREATE TABLE runtimes (
@@ -25,51 +34,168 @@ CREATE TABLE runtimes (
 )
 """
 
-# TODO: quick oneshot for counts
-# select tool_id, count(tool_id) as run_count from job where state = 'ok' group by tool_id order by tool_id
+# percentile expressions return an array of quant_1st, median, quant_3rd, perc_95, perc_99
+PERCENTILES_SQL = """\
+percentile_cont(ARRAY[0.25, 0.50, 0.75, 0.95, 0.99]) WITHIN GROUP (ORDER BY m.metric_value)"""
 
-COUNT_SQL = """
+# approximate percentiles using the tdigest extension, avoids sorting all values for tools with very many jobs
+TDIGEST_PERCENTILES_SQL = """\
+tdigest_percentile(m.metric_value::double precision, 100, ARRAY[0.25, 0.50, 0.75, 0.95, 0.99])"""
+
+TDIGEST_AVAILABLE_SQL = """
+SELECT
+    count(*)
+FROM pg_extension
+WHERE
+    extname = 'tdigest'
+"""
+
+# {percentiles} is replaced with one of the percentile expressions above
+# jobs are joined to their metrics and nothing prevents a job having more than one runtime_seconds metric, so count
+# distinct jobs to keep run_count the number of successful jobs
+SUMMARY_COLUMNS_SQL = """\
+    j.tool_id,
+    j.tool_version,
+    count(DISTINCT j.id) AS run_count,
+    min(m.metric_value) AS min,
+    {percentiles} ::bigint[] AS pcts,
+    avg(m.metric_value) AS mean,
+    max(m.metric_value) AS max,
+    sum(m.metric_value) AS sum,
+    stddev(m.metric_value) AS stddev"""
+
+SUMMARY_SQL = f"""
+SELECT
+{SUMMARY_COLUMNS_SQL}
+FROM unnest(%s::text[], %s::text[]) AS t (tool_id, tool_version)
+JOIN job j
+    ON j.tool_id = t.tool_id
+    AND j.tool_version = t.tool_version
+    AND j.state = 'ok'
+-- LEFT JOIN so that ok jobs without a runtime metric are still included in run_count
+LEFT JOIN job_metric_numeric m
+    ON m.job_id = j.id
+    AND m.metric_name = 'runtime_seconds'
+GROUP BY
+    j.tool_id,
+    j.tool_version
+"""
+
+# precomputed stats for all tools, so the per-tool sorts happen when the view is refreshed rather than at query time
+CREATE_ROLLUP_SQL = f"""
+CREATE MATERIALIZED VIEW tool_runtime_rollup AS
 SELECT
-    count(tool_id) AS run_count
-FROM job
+{SUMMARY_COLUMNS_SQL}
+FROM job j
+LEFT JOIN job_metric_numeric m
+    ON m.job_id = j.id
+    AND m.metric_name = 'runtime_seconds'
 WHERE
-    tool_id = %s
-    AND tool_version = %s
-    AND state = 'ok'
+    j.state = 'ok'
+GROUP BY
+    j.tool_id,
+    j.tool_version
+"""
+
+# a unique index is required for REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE_ROLLUP_INDEX_SQL = """
+CREATE UNIQUE INDEX tool_runtime_rollup_tool_idx ON tool_runtime_rollup (tool_id, tool_version)
+"""
+
+ROLLUP_EXISTS_SQL = """
+SELECT
+    to_regclass('tool_runtime_rollup') IS NOT NULL
+"""
+
+REFRESH_ROLLUP_SQL = """
+REFRESH MATERIALIZED VIEW CONCURRENTLY tool_runtime_rollup
+"""
+
+ROLLUP_SUMMARY_SQL = """
+SELECT
+    r.*
+FROM unnest(%s::text[], %s::text[]) AS t (tool_id, tool_version)
+JOIN tool_runtime_rollup r
+    ON r.tool_id = t.tool_id
+    AND r.tool_version = t.tool_version
+"""
+
+# must count the same thing as run_count in SUMMARY_COLUMNS_SQL (successful jobs, not metric rows) or tools will be seen
+# as having new jobs on every run
+RUN_COUNT_SQL = """
+SELECT
+    j.tool_id,
+    j.tool_version,
+    count(j.id) AS run_count
+FROM unnest(%s::text[], %s::text[]) AS t (tool_id, tool_version)
+JOIN job j
+    ON j.tool_id = t.tool_id
+    AND j.tool_version = t.tool_version
+    AND j.state = 'ok'
+GROUP BY
+    j.tool_id,
+    j.tool_version
 """
 
-SUMMARY_SQL = """
-WITH runtime_data AS (
-    SELECT
-        metric_value
-    FROM job_metric_numeric
-    WHERE
-        metric_name = 'runtime_seconds'
-        AND
-            job_id in (
-                SELECT
-                    id
-                FROM job
-                WHERE
-                    tool_id = %s
-                    AND tool_version = %s
-                    AND state = 'ok'
-            )
-    )
+# covering indexes so the stats queries can use index-only scans, CONCURRENTLY so job writes are not blocked during the
+# build (this cannot be run inside a transaction)
+CREATE_INDEXES_SQL = {
+    "job_tool_state_idx": """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS job_tool_state_idx
+        ON job (tool_id, tool_version) INCLUDE (id)
+        WHERE state = 'ok'
+    """,
+    "jmn_runtime_idx": """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS jmn_runtime_idx
+        ON job_metric_numeric (job_id) INCLUDE (metric_value)
+        WHERE metric_name = 'runtime_seconds'
+    """,
+}
+
+# a failed or cancelled concurrent build leaves an invalid index behind that IF NOT EXISTS does not replace
+INDEX_VALID_SQL = """
 SELECT
-    min(metric_value) AS min,
-    percentile_cont(0.25) WITHIN GROUP (ORDER BY metric_value) ::bigint AS quant_1st,
-    percentile_cont(0.50) WITHIN GROUP (ORDER BY metric_value) ::bigint AS median,
-    avg(metric_value) AS mean,
-    percentile_cont(0.75) WITHIN GROUP (ORDER BY metric_value) ::bigint AS quant_3rd,
-    percentile_cont(0.95) WITHIN GROUP (ORDER BY metric_value) ::bigint AS perc_95,
-    percentile_cont(0.99) WITHIN GROUP (ORDER BY metric_value) ::bigint AS perc_99,
-    max(metric_value) AS max,
-    sum(metric_value) AS sum,
-    stddev(metric_value) AS stddev
-FROM runtime_data
+    indisvalid
+FROM pg_index
+WHERE
+    indexrelid = to_regclass(%s)
+"""
+
+CREATE_HTTP_CACHE_SQL = """
+CREATE TABLE IF NOT EXISTS http_cache (
+    url text PRIMARY KEY,
+    etag text,
+    last_modified text,
+    body blob
+)
 """
 
+SELECT_HTTP_CACHE_SQL = """
+SELECT
+    rowid,
+    etag,
+    last_modified
+FROM http_cache
+WHERE
+    url = ?
+"""
+
+DELETE_HTTP_CACHE_SQL = """
+DELETE FROM http_cache
+WHERE
+    url = ?
+"""
+
+UPSERT_HTTP_CACHE_SQL = """
+INSERT OR REPLACE INTO http_cache (
+    url,
+    etag,
+    last_modified,
+    body)
+VALUES (?, ?, ?, zeroblob(?))
+"""
+
+# parameters are positional, in the order returned by Tool.upsert_values()
 INSERT_TOOL_SQL = """
 INSERT INTO runtimes (
     tool_id,
@@ -82,37 +208,28 @@ INSERT INTO runtimes (
     pct95_runtime,
     pct99_runtime,
     max_runtime)
-VALUES (
-    :tool_id,
-    :base_tool_id,
-    :tool_version,
-    :run_count,
-    :min_runtime,
-    :median_runtime,
-    :mean_runtime,
-    :pct95_runtime,
-    :pct99_runtime,
-    :max_runtime)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
 """
 
 UPDATE_TOOL_SQL = """
 UPDATE
     runtimes
 SET
-    tool_id = :tool_id,
+    tool_id = ?1,
     update_time = datetime('now'),
-    run_count = :run_count,
-    min_runtime = :min_runtime,
-    median_runtime = :median_runtime,
-    mean_runtime = :mean_runtime,
-    pct95_runtime = :pct95_runtime,
-    pct99_runtime = :pct99_runtime,
-    max_runtime = :max_runtime
+    run_count = ?4,
+    min_runtime = ?5,
+    median_runtime = ?6,
+    mean_runtime = ?7,
+    pct95_runtime = ?8,
+    pct99_runtime = ?9,
+    max_runtime = ?10
 WHERE
-    tool_id = :tool_id
-    AND tool_version = :tool_version
+    tool_id = ?1
+    AND tool_version = ?3
 """
 
+# parameters are positional, in the order returned by Tool.key_values()
 DEACTIVATE_TOOL_SQL = """
 UPDATE
     runtimes
@@ -120,27 +237,34 @@ SET
     update_time = datetime('now'),
     active = false
 WHERE
-    tool_id = :tool_id
-    AND tool_version = :tool_version
+    tool_id = ?
+    AND tool_version = ?
 """
 
 
+@dataclass(slots=True)
 class Tool:
-    def __init__(self, id, version, base_id=None, update_time=None, run_count=-1, min_runtime=None, median_runtime=None, mean_runtime=None, pct95_runtime=None, pct99_runtime=None, max_runtime=None, active=True):
-        self.id = id
-        self.version = version
-        self.base_id = base_id
-        self.update_time = update_time
-        self.run_count = run_count
-        self.min_runtime = min_runtime
-        self.median_runtime = median_runtime
-        self.mean_runtime = mean_runtime
-        self.pct95_runtime = pct95_runtime
-        self.pct99_runtime = pct99_runtime
-        self.max_runtime = max_runtime
-        self.active = active
-        assert version is not None
+    id: str
+    version: str
+    base_id: Optional[str] = None
+    update_time: Optional[str] = None
+    run_count: int = -1
+    min_runtime: Optional[int] = None
+    median_runtime: Optional[int] = None
+    mean_runtime: Optional[int] = None
+    pct95_runtime: Optional[int] = None
+    pct99_runtime: Optional[int] = None
+    max_runtime: Optional[int] = None
+    active: bool = True
+    key: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        assert self.version is not None
+        self.id = sys.intern(self.id)
+        self.version = sys.intern(self.version)
         self.set_base_id()
+        # built once and interned since tools are looked up by key in every diff
+        self.key = sys.intern(f"{self.base_id}/{self.version}")
 
     def set_base_id(self):
         if self.base_id is not None:
@@ -150,35 +274,43 @@ class Tool:
             assert self.version == id_version, f"{self.version} != {id_version}"
         else:
             self.base_id = self.id
+        # many versions share a base id
+        self.base_id = sys.intern(self.base_id)
 
     def __str__(self):
         return f"{self.key}: run_count={self.run_count}, min_runtime={self.min_runtime}, median_runtime={self.median_runtime}, mean_runtime={self.mean_runtime}, pct95_runtime={self.pct95_runtime}, pct99_runtime={self.pct99_runtime}, max_runtime={self.max_runtime}, active={self.active}"
 
-    @property
-    def key(self):
-        return f"{self.base_id}/{self.version}"
-
     def update_stats(self, summary):
+        if summary is None:
+            # no successful jobs for this tool
+            self.min_runtime = self.median_runtime = self.mean_runtime = -1
+            self.pct95_runtime = self.pct99_runtime = self.max_runtime = -1
+            return
+        # pcts is NULL if none of the jobs have a runtime metric
+        pcts = summary.pcts or [None] * 5
         self.min_runtime = int(summary.min or -1)
-        self.median_runtime = int(summary.median or -1)
+        self.median_runtime = int(pcts[1] or -1)
         self.mean_runtime = int(summary.mean or -1)
-        self.pct95_runtime = int(summary.perc_95 or -1)
-        self.pct99_runtime = int(summary.perc_99 or -1)
+        self.pct95_runtime = int(pcts[3] or -1)
+        self.pct99_runtime = int(pcts[4] or -1)
         self.max_runtime = int(summary.max or -1)
 
+    def key_values(self):
+        return (self.id, self.version)
+
     def upsert_values(self):
-        return {
-            "tool_id": self.id,
-            "base_tool_id": self.base_id,
-            "tool_version": self.version,
-            "run_count": self.run_count,
-            "min_runtime": self.min_runtime,
-            "median_runtime": self.median_runtime,
-            "mean_runtime": self.mean_runtime,
-            "pct95_runtime": self.pct95_runtime,
-            "pct99_runtime": self.pct99_runtime,
-            "max_runtime": self.max_runtime,
-        }
+        return (
+            self.id,
+            self.base_id,
+            self.version,
+            self.run_count,
+            self.min_runtime,
+            self.median_runtime,
+            self.mean_runtime,
+            self.pct95_runtime,
+            self.pct99_runtime,
+            self.max_runtime,
+        )
 
 
 def handle_args():
@@ -187,110 +319,302 @@ def handle_args():
     parser.add_argument("--older-than", default="1 week", help="Update all entries older than")
     parser.add_argument("--galaxy-url", default="https://usegalaxy.org", help="Galaxy server URL")
     parser.add_argument("--tool-id", help="Force update to given tool")
+    parser.add_argument("--pg-workers", type=int, default=1, help="Number of parallel PostgreSQL connections used to collect stats")
+    parser.add_argument("--approximate", action="store_true", help="Use the tdigest extension to approximate percentiles")
+    parser.add_argument("--create-indexes", action="store_true", help="Create PostgreSQL indexes for the stats queries and exit")
+    parser.add_argument("--rollup", action="store_true", help="Read stats from the tool_runtime_rollup materialized view (create it first with --refresh-rollup)")
+    parser.add_argument("--refresh-rollup", action="store_true", help="Create or refresh the tool_runtime_rollup materialized view and exit")
     parser.add_argument("sqlite_db_file", help="Runtime SQLite database file")
     return parser.parse_args()
 
 
+# batch queries take arrays of tool ids and versions
+def execute_tools(cur, sql, tools):
+    cur.execute(sql, ([tool.id for tool in tools], [tool.version for tool in tools]))
+    return cur.fetchall()
+
+
+# file-like wrapper that copies everything read from the wrapped stream to a temporary file, which stays in memory only
+# while it is small
+class _TeeReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.buffer.write(data)
+        return data
+
+
 def tool_factory(cursor, row):
-    tool_id = row[0]
-    version = row[2]
-    kwargs_as_args = row[1:2] + row[3:]
-    return Tool(tool_id, version, *kwargs_as_args)
+    return Tool(*row)
 
 
 class App:
-    def __init__(self, db_file=None, pg_conn_string=None, galaxy_url=None, older_than=None):
+    def __init__(self, db_file=None, pg_conn_string=None, galaxy_url=None, older_than=None, rollup=False, approximate=False, pg_workers=1):
         self.db_file = db_file
         self.pg_conn_string = pg_conn_string
         self.galaxy_url = galaxy_url
         self.older_than = older_than
+        self.rollup = rollup
+        self.approximate = approximate
+        self.pg_workers = max(pg_workers, 1)
+        self.__pg_pool = None
         self.__pg_con = None
+        self.__sqlite_con = None
+        self.__http_session = None
+
+    @property
+    def pg_pool(self):
+        if not self.__pg_pool:
+            # one connection for each worker plus pg_con, connections are only opened when needed
+            self.__pg_pool = ThreadedConnectionPool(1, self.pg_workers + 1, self.pg_conn_string)
+        return self.__pg_pool
 
     @property
     def pg_con(self):
         if not self.__pg_con:
-            self.__pg_con = psycopg2.connect(self.pg_conn_string)
+            self.__pg_con = self.pg_pool.getconn()
         return self.__pg_con
 
+    @property
+    def http_session(self):
+        if not self.__http_session:
+            # reuse connections across requests and retry transient failures
+            self.__http_session = requests.Session()
+            self.__http_session.headers["Accept-Encoding"] = "gzip"
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504)))
+            self.__http_session.mount("https://", adapter)
+            self.__http_session.mount("http://", adapter)
+        return self.__http_session
+
+    @property
+    def sqlite_con(self):
+        if not self.__sqlite_con:
+            # autocommit mode, transactions are managed explicitly
+            self.__sqlite_con = sqlite3.connect(self.db_file, isolation_level=None, cached_statements=256)
+            # the journal mode is stored in the database file, which is read by other consumers, and WAL would require
+            # them to have write access to the -shm file and a local filesystem
+            self.__sqlite_con.execute("PRAGMA journal_mode=DELETE")
+            self.__sqlite_con.execute("PRAGMA synchronous=NORMAL")
+            self.__sqlite_con.execute("PRAGMA cache_size=-64000")
+        return self.__sqlite_con
+
     def make_db(self):
-        con = sqlite3.connect(self.db_file)
-        cur = con.cursor()
+        cur = self.sqlite_con.cursor()
         cur.execute(CREATE_SQL)
+        cur.execute(CREATE_HTTP_CACHE_SQL)
+
+    def http_get_items(self, url, prefix="item"):
+        # conditionally fetch url, reusing the last response body if the server says it has not changed, and stream
+        # the JSON elements at prefix rather than loading the whole document
+        cur = self.sqlite_con.cursor()
+        cur.execute(CREATE_HTTP_CACHE_SQL)
+        cur.execute(SELECT_HTTP_CACHE_SQL, (url,))
+        cached = cur.fetchone()
+        headers = {}
+        if cached:
+            rowid, etag, last_modified = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        # closing the response releases the connection back to the session's pool
+        with self.http_session.get(url, headers=headers, stream=True) as response:
+            if cached and response.status_code == 304:
+                print(f"{url} not modified, using cached response")
+                # read the cached body incrementally rather than loading it
+                with self.sqlite_con.blobopen("http_cache", "body", rowid, readonly=True) as body:
+                    yield from ijson.items(body, prefix)
+                return
+            response.raise_for_status()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            response.raw.decode_content = True
+            if not (etag or last_modified):
+                # nothing to revalidate with, don't keep sending the validators of an old response
+                cur.execute(DELETE_HTTP_CACHE_SQL, (url,))
+                yield from ijson.items(response.raw, prefix)
+                return
+            raw = _TeeReader(response.raw)
+            with raw.buffer:
+                yield from ijson.items(raw, prefix)
+                # allocate the blob and then copy the body into it incrementally
+                cur.execute(UPSERT_HTTP_CACHE_SQL, (url, etag, last_modified, raw.buffer.tell()))
+                raw.buffer.seek(0)
+                with self.sqlite_con.blobopen("http_cache", "body", cur.lastrowid) as body:
+                    shutil.copyfileobj(raw.buffer, body)
 
     def get_server_tools(self):
         tools = {}
         url = self.galaxy_url.rstrip("/") + "/api/tools?in_panel=false"
-        response = requests.get(url)
-        for tool_elem in response.json():
+        for tool_elem in self.http_get_items(url):
             tool = Tool(tool_elem["id"], tool_elem["version"])
             tools[tool.key] = tool
         return tools
 
-    def get_db_tools(self, for_update=False):
+    def get_db_tools(self):
+        # returns all active tools and the keys of those last updated before older_than
         tools = {}
-        sql = """SELECT * FROM runtimes WHERE active"""
-        args = None
-        if for_update:
-            sql += " AND update_time < datetime('now', ?)"
-            args = (f"-{self.older_than}",)
-        con = sqlite3.connect(self.db_file)
-        con.row_factory = tool_factory
-        cur = con.cursor()
-        if args:
-            cur.execute(sql, args)
-        else:
-            cur.execute(sql)
-        for tool in cur.fetchall():
+        stale_keys = set()
+        # columns in Tool field order
+        sql = """
+            SELECT
+                tool_id, tool_version, base_tool_id, update_time, run_count, min_runtime, median_runtime, mean_runtime,
+                pct95_runtime, pct99_runtime, max_runtime, active, update_time < datetime('now', ?) AS stale
+            FROM runtimes
+            WHERE active
+        """
+        cur = self.sqlite_con.cursor()
+        cur.execute(sql, (f"-{self.older_than}",))
+        for row in cur:
+            tool = tool_factory(cur, row[:-1])
             tools[tool.key] = tool
-        return tools
+            if row[-1]:
+                stale_keys.add(tool.key)
+        return tools, stale_keys
 
-    def run_count(self, tool):
+    @property
+    def percentiles_sql(self):
+        if self.approximate:
+            with self.pg_con.cursor() as cur:
+                cur.execute(TDIGEST_AVAILABLE_SQL)
+                available = cur.fetchone()[0]
+            if available:
+                return TDIGEST_PERCENTILES_SQL
+            print("WARNING: tdigest extension is not installed (CREATE EXTENSION tdigest), using exact percentiles")
+            self.approximate = False
+        return PERCENTILES_SQL
+
+    def index_valid(self, cur, name):
+        # returns None if the index does not exist
+        cur.execute(INDEX_VALID_SQL, (name,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def create_indexes(self):
+        con = self.pg_con
+        con.autocommit = True
+        try:
+            with con.cursor() as cur:
+                for name, sql in CREATE_INDEXES_SQL.items():
+                    if self.index_valid(cur, name) is False:
+                        print(f"dropping invalid index: {name}")
+                        cur.execute(f"DROP INDEX CONCURRENTLY {name}")
+                    print(f"creating index: {name}")
+                    cur.execute(sql)
+                    if not self.index_valid(cur, name):
+                        print(f"WARNING: index {name} is not valid and will not be used, rerun --create-indexes to rebuild")
+        finally:
+            con.autocommit = False
+
+    def refresh_rollup(self):
+        with self.pg_con.cursor() as cur:
+            cur.execute(ROLLUP_EXISTS_SQL)
+            if cur.fetchone()[0]:
+                cur.execute(REFRESH_ROLLUP_SQL)
+            else:
+                # creating the view populates it, no need to refresh
+                print("creating tool_runtime_rollup")
+                cur.execute(CREATE_ROLLUP_SQL.format(percentiles=self.percentiles_sql))
+                cur.execute(CREATE_ROLLUP_INDEX_SQL)
+        self.pg_con.commit()
+
+    def batch_summary_stats(self, tools):
+        stats = {}
+        if not tools:
+            return stats
+        sql = ROLLUP_SUMMARY_SQL if self.rollup else SUMMARY_SQL.format(percentiles=self.percentiles_sql)
+        if self.pg_workers == 1:
+            # no need for a second connection or a thread
+            with self.pg_con.cursor(cursor_factory=NamedTupleCursor) as cur:
+                results = [execute_tools(cur, sql, tools)]
+        else:
+            # split the tools among the workers so that the queries run concurrently on separate connections
+            pool = self.pg_pool
+            chunk_size = -(-len(tools) // self.pg_workers)
+            chunks = [tools[i:i + chunk_size] for i in range(0, len(tools), chunk_size)]
+            with ThreadPoolExecutor(max_workers=self.pg_workers) as executor:
+                results = list(executor.map(lambda chunk: self._summary_stats(pool, sql, chunk), chunks))
+        for summaries in results:
+            for summary in summaries:
+                stats[(sys.intern(summary.tool_id), sys.intern(summary.tool_version))] = summary
+        return stats
+
+    def _summary_stats(self, pool, sql, tools):
+        con = pool.getconn()
+        try:
+            with con.cursor(cursor_factory=NamedTupleCursor) as cur:
+                return execute_tools(cur, sql, tools)
+        finally:
+            pool.putconn(con)
+
+    def tools_with_new_jobs(self, tools):
+        # returns the tools whose successful job count has changed since their last update, compared by count rather
+        # than by time since job and runtimes update times come from different clocks
+        if not tools:
+            return []
         with self.pg_con.cursor() as cur:
-            cur.execute(COUNT_SQL, (tool.id, tool.version))
-            count = cur.fetchone()[0]
-        return count
-
-    def summary_stats(self, tool):
-        with self.pg_con.cursor(cursor_factory=NamedTupleCursor) as cur:
-            cur.execute(SUMMARY_SQL, (tool.id, tool.version))
-            summary = cur.fetchone()
-        return summary
-
-    def commit_tool(self, tool, sql):
-        con = sqlite3.connect(self.db_file)
-        cur = con.cursor()
-        cur.execute(sql, tool.upsert_values())
-        con.commit()
-
-    def upsert_tool(self, tool, upsert_sql):
+            rows = execute_tools(cur, RUN_COUNT_SQL, tools)
+        run_counts = {(sys.intern(tool_id), sys.intern(tool_version)): run_count for tool_id, tool_version, run_count in rows}
+        return [tool for tool in tools if run_counts.get((tool.id, tool.version), 0) != tool.run_count]
+
+    def refresh_tool(self, tool, stats):
         print(f"processing {tool.key=}")
-        count = self.run_count(tool)
+        summary = stats.get((tool.id, tool.version))
+        count = summary.run_count if summary else 0
         if tool.run_count != count:
-            # don't bother collecting stats if the run count has not changed, just touch the update time
+            # don't bother updating stats if the run count has not changed, just touch the update time
             tool.run_count = count
-            summary = self.summary_stats(tool)
             print(f"{tool.key=}: {summary=}")
             tool.update_stats(summary)
             print(tool)
-        self.commit_tool(tool, upsert_sql)
+        return tool.upsert_values()
 
     def handle_tool_changes(self):
         server_tools = self.get_server_tools()
-        db_tools = self.get_db_tools()
-        server_tool_keys = set(server_tools.keys())
-        db_tool_keys = set(db_tools.keys())
-        for tool_key in server_tool_keys - db_tool_keys:
-            self.upsert_tool(server_tools[tool_key], INSERT_TOOL_SQL)
-        for tool_key in db_tool_keys - server_tool_keys:
-            print(f"deactivating removed tool: {tool.key}")
-            self.commit_tool(tool, DEACTIVATE_TOOL_SQL)
-        for tool_key, tool in self.get_db_tools(for_update=True).items():
-            self.upsert_tool(tool, UPDATE_TOOL_SQL)
+        db_tools, stale_keys = self.get_db_tools()
+        new_tools = [server_tools[tool_key] for tool_key in server_tools.keys() - db_tools.keys()]
+        stale_tools = [db_tools[tool_key] for tool_key in stale_keys & server_tools.keys()]
+        if self.rollup:
+            # stats are cheap to read from the rollup, cheaper than counting jobs
+            changed_tools = stale_tools
+        else:
+            # only recompute stats for tools that have new jobs, the rest just have their update time touched
+            changed_tools = self.tools_with_new_jobs(stale_tools)
+        # collect stats for all tools in a single query rather than two per tool
+        stats = self.batch_summary_stats(new_tools + changed_tools)
+        insert_rows = [self.refresh_tool(tool, stats) for tool in new_tools]
+        update_rows = [self.refresh_tool(tool, stats) for tool in changed_tools]
+        changed_keys = {tool.key for tool in changed_tools}
+        update_rows.extend(tool.upsert_values() for tool in stale_tools if tool.key not in changed_keys)
+        deactivate_rows = []
+        for tool_key in db_tools.keys() - server_tools.keys():
+            print(f"deactivating removed tool: {tool_key}")
+            deactivate_rows.append(db_tools[tool_key].key_values())
+        con = self.sqlite_con
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            cur = con.cursor()
+            cur.executemany(INSERT_TOOL_SQL, insert_rows)
+            cur.executemany(DEACTIVATE_TOOL_SQL, deactivate_rows)
+            cur.executemany(UPDATE_TOOL_SQL, update_rows)
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
 
 
 def main():
     args = handle_args()
-    app = App(db_file=args.sqlite_db_file, pg_conn_string=args.pgconn, galaxy_url=args.galaxy_url, older_than=args.older_than)
+    app = App(db_file=args.sqlite_db_file, pg_conn_string=args.pgconn, galaxy_url=args.galaxy_url, older_than=args.older_than, rollup=args.rollup, approximate=args.approximate, pg_workers=args.pg_workers)
+    if args.create_indexes:
+        app.create_indexes()
+        return
+    if args.refresh_rollup:
+        app.refresh_rollup()
+        return
     if not os.path.exists(args.sqlite_db_file):
         app.make_db()
     if args.tool_id: